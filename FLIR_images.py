@@ -2,11 +2,13 @@
 # coding: utf8
 
 """
-FLIR_image.py
+FLIR_images.py
 
 Provides:
 FLIR_image : class 
     Provides methods for handling FLIR thermal images
+process_batch : function
+     Converts many FLIR images in one pass, sharing one exiftool process
 raw_to_temperature : function
      Converts RAW thermal image values to temperature
 temperature_to_raw : function
@@ -17,9 +19,23 @@ https://exiftool.org/forum/index.php?topic=4898.60
 """
 
 import os
+import math
+import base64
+import weakref
+import tempfile
+import threading
 import numpy as np
 import exiftool
 import tifffile
+import imagecodecs
+from pathlib import Path
+from functools import cached_property
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from numba import njit, prange
+
+__all__ = ['FLIR_image', 'process_batch', 'raw_to_temperature', 
+           'temperature_to_raw']
 
 
 # Example of Planck constants
@@ -31,11 +47,15 @@ class FLIR_image():
 
     Provides the following methods:
         get_metadata : 
+        get_position :
         get_planck_coeffs :
-        extract_raw_image : extracts the raw thermal image from metadata and 
-            saves it as an appropriately named file in the current directory.
-        raw_to_temperature : converts raw thermal image to temperature using
+        extract_raw_image : extracts the raw thermal image from metadata.
+        temperature : converts raw thermal image to temperature using
             the Planck coefficients defined in the metadata.
+        save_data : saves the raw or temperature image as an appropriately 
+            named file alongside the original image.
+        close : terminates the exiftool process kept open by the instance.
+            Called automatically when used as a context manager.
 
     TO DO:
     ------
@@ -44,145 +64,373 @@ class FLIR_image():
     """
 
     def __init__(self, filename, e=1., tau=1., bitdepth=16, outtype='raw',
-                 includeexif=True, removeoriginal=True, thermalim=True):
+                 includeexif=True, removeoriginal=True, thermalim=True,
+                 et=None):
         self.filename  = filename
-        self.metadata  = self.get_metadata()
-        self.position  = self.get_position()
+        self._own_et   = et is None
+        if self._own_et:  # otherwise share a running exiftool process
+            et = exiftool.ExifTool()
+            et.start()
+        self._et       = et
+        self._raw_file = None  # removes the memory-mapped raw image file
+        try:
+            self._parse(metadata=self.get_metadata(), e=e, tau=tau, 
+                        bitdepth=bitdepth, outtype=outtype, 
+                        thermalim=thermalim)
+        except BaseException:
+            self.close()  # don't leave exiftool running
+            raise
+        self.includeexif    = includeexif
+        self.removeoriginal = removeoriginal
+
+
+    def _parse(self, metadata, e, tau, bitdepth, outtype, thermalim):
+        """Set the attributes derived from metadata (see __init__)"""
+        # only the parsed fields are kept, not the full metadata dictionary
+        self.position  = self.get_position(metadata)
         self.outtype   = None
         self.thermalim = thermalim
         if self.thermalim:
-            self.raw_fmt  = self.metadata["APP1:RawThermalImageType"].lower()
-            self.planck   = self.get_planck_coeffs()
+            self.raw_fmt  = metadata["APP1:RawThermalImageType"].lower()
+            self.planck   = self.get_planck_coeffs(metadata)
             self.raw      = self.extract_raw_image()
-            self.temp     = raw_to_temperature(self.raw, self.planck)
-            self.T_stats  = {"T_min": self.temp.min(),
-                             "T_max": self.temp.max(),
-                             "T_mean": self.temp.mean(),
-                             "T_std": self.temp.std(),
-                             "T_med": np.median(self.temp)}
             self.e        = e    # surface emissivity
             self.tau      = tau  # atmospheric transmissivity
             self.outtype  = outtype
             self.bitdepth = bitdepth  # choose 16, 32 or 64 bits
 
-        self.width  = self.metadata["File:ImageWidth"]
-        self.height = self.metadata["File:ImageHeight"]
+        self.width  = metadata["File:ImageWidth"]
+        self.height = metadata["File:ImageHeight"]
         self.shape  = (self.height, self.width)
-        self.includeexif    = includeexif
-        self.removeoriginal = removeoriginal
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def close(self, keep_raw=True):
+        """
+        Terminate the exiftool process used by this image, unless it was 
+        passed in by the caller, and remove the temporary raw image file.
+        The raw image is first read into memory, unless keep_raw is False 
+        (e.g. because the instance is about to be discarded).
+        """
+        if self._own_et and self._et.running:
+            self._et.terminate()
+        if self._raw_file is not None and self._raw_file.alive:
+            if keep_raw and hasattr(self, "raw"):
+                self.raw = np.array(self.raw)  # keep raw usable once unmapped
+            self._raw_file()
+
+
+    @cached_property
+    def temp(self):
+        """Temperature image, computed from the raw image on first access"""
+        return self.temperature()
+
+
+    def temperature(self, dtype=np.float32):
+        """
+        Return the temperature image (in Kelvin) as a new array of the given
+        dtype.  Unlike temp, the result is not kept by the instance.
+        """
+        return raw_to_temperature(self.raw, self.planck, dtype=dtype)
+
+
+    @cached_property
+    def T_stats(self):
+        """Basic statistics of the temperature image"""
+        t = self.temp.ravel()
+        T_min, T_max, T_mean, T_std = _stats(t)
+        mid = t.size // 2
+        T_med = math.nan if math.isnan(T_mean) else np.partition(t, mid)[mid]
+        return {"T_min": float(T_min),
+                "T_max": float(T_max),
+                "T_mean": float(T_mean),
+                "T_std": float(T_std),
+                "T_med": float(T_med)}
 
 
     def get_metadata(self):
         """Extract metadata from image file using exiftool"""
-        with exiftool.ExifTool() as et:
-            self.metadata = et.get_metadata(self.filename)
-        return self.metadata
+        return self._et.get_metadata(self.filename)
 
 
-    def get_position(self):
+    def get_position(self, metadata):
         """ Extract "GPS" position from metadata """
-        self.position = {}
-        self.metadata['EXIF:GPSLatitude']  = None
-        self.metadata['EXIF:GPSLongitude'] = None
-        self.metadata['EXIF:GPSAltitude']  = None
-        if 'EXIF:GPSLatitude' in self.metadata.keys():
-            self.position['latitude']  = self.metadata['EXIF:GPSLatitude']
-        if 'EXIF:GPSLongitude' in self.metadata.keys():
-            self.position['longitude'] = self.metadata['EXIF:GPSLongitude']
-        if 'EXIF:GPSAltitude' in self.metadata.keys():
-            self.position['altitude']  = self.metadata['EXIF:GPSAltitude']
-            
-        return self.position
-
-
-    def get_planck_coeffs(self):
-        self.planck = {}
-        for key, val in self.metadata.items():
-            if "planck" in key.lower():
-                self.planck[key[11:]] = val
-        return self.planck
+        keys = (('EXIF:GPSLatitude', 'latitude'),
+                ('EXIF:GPSLongitude', 'longitude'),
+                ('EXIF:GPSAltitude', 'altitude'))
+        return {name: metadata[key] for key, name in keys if key in metadata}
+
+
+    def get_planck_coeffs(self, metadata):
+        """ Extract Planck constants from metadata """
+        return {key[11:]: val for key, val in metadata.items()
+                if "planck" in key.lower()}
     
 
     def extract_raw_image(self):
         """
         Extract raw thermal image from metadata.  Requires exiftool to be 
-        installed on the system, and creates a temporary image file that is 
-        subsequently read using tifffile's imread.
+        installed on the system.  The image is requested (base64-encoded)
+        from the running exiftool process.  TIFF images are written to a 
+        temporary file and memory-mapped, so that pages are only read when 
+        needed; the file is removed by the close method or, failing that, 
+        when the instance is garbage collected.
         """
-        metadata = self.metadata
-        fmt = metadata["APP1:RawThermalImageType"].lower()
-        os.system(f"exiftool {self.filename} -rawthermalimage -b > "
-                  + f"{self.filename}_temp")
-        # with exiftool.ExifTool() as et:
-        #     et.execute(bytes(self.filename, "utf-8"),
-        #                b"-rawthermalimage -b > temp")
+        fmt = self.raw_fmt
+        data = self._et.execute_json(b"-b", b"-rawthermalimage",
+                                     bytes(self.filename, "utf-8"))
+        buf = base64.b64decode(data[0]["APP1:RawThermalImage"][7:])  # base64:
 
         # Only do this if the format is tiff.  Method should reflect image
         # type
         if 'tif' in fmt:
-            self.raw = tifffile.imread(f"{self.filename}_temp")
+            with tempfile.NamedTemporaryFile(suffix=".tif", 
+                                             delete=False) as f:
+                f.write(buf)
+            self._raw_file = weakref.finalize(self, os.remove, f.name)
+            try:
+                self.raw = tifffile.memmap(f.name, mode='r')
+                if not self.raw.dtype.isnative:  # e.g. big-endian cameras
+                    raise ValueError("non-native byte order")
+            except ValueError:  # compressed or otherwise not memory-mappable
+                self.raw = imagecodecs.tiff_decode(buf)
+                self._raw_file()
         if fmt == 'png':
-            from matplotlib.pyplot import imread
-            self.raw = imread(f"{self.filename}_temp")
-        os.system(f"rm {self.filename}_temp")
+            # FLIR stores 16-bit PNG data little-endian, against the PNG spec
+            self.raw = imagecodecs.png_decode(buf).byteswap()
         return self.raw
 
 
-    def save_data(self, filename=None):
+    def save_data(self, filename=None, compression='zstd', tile=(256, 256)):
         """
-        Write image data to file using tifffile.imwrite.
+        Write image data to file using tifffile.imwrite and, if requested,
+        copy the exif data of the original image to it.
 
         Parameters
         ----------
-        type : str (optional)
-            Selects between RAW ("raw") or temperature data as the image 
-            contents.  Default is "raw".
         filename : str (optional)
             Specify an alternative output filename.  By default, this will be 
             the same as the input file except that the extension (e.g. jpg or 
             JPG) will be replaced by "tiff".  
+        compression : str (optional)
+            Compression scheme passed to tifffile.imwrite, e.g. "zstd" 
+            (default) or "zlib".  Use None to write uncompressed data.
+        tile : tuple (optional)
+            Shape of the tiles (multiples of 16) in which the image is 
+            stored.  Default is (256, 256).  Use None for a strip layout.
 
         Returns
         -------
         None
 
+        """
+        out_fname = self.write_data(filename, compression, tile)
+        self.copy_exif(out_fname)
+        return
+
+
+    def write_data(self, filename=None, compression='zstd', tile=(256, 256)):
+        """
+        Write image data to file using tifffile.imwrite.  The type of data
+        written, RAW ("raw") or temperature, is selected by the "outtype" 
+        attribute.
+
+        Parameters
+        ----------
+        filename, compression, tile : (optional)
+            See save_data.
+
+        Returns
+        -------
+        out_fname : str
+            Name of the file written.
+
         """
         if not self.thermalim:
             raise AttributeError('"save_data" method available only for '
                                  'thermal images')
 
-        out_fname = ".".join(self.filename.split(".")[:-1])
+        out_fname = str(Path(self.filename).with_suffix(""))
         if self.outtype.lower() == "raw":
-            data = self.raw.astype('uint16')
+            datatype = 'uint16'
+            data = self.raw
         else:
             out_fname += "_T"
-            data = self.temp
+            datatype = {16: 'float16', 32: 'float32'}.get(self.bitdepth, 
+                                                          'float64')
+            # computed in (at least) single precision; narrowing to float16 
+            # is left to the writer, tile by tile
+            data = self.temperature(np.promote_types(datatype, np.float32))
         out_fname += "." + self.raw_fmt
 
         if filename is not None:
             out_fname = filename
 
-        datatype = 'float16'
-        if self.bitdepth == 16:
-            datatype = 'uint16'
-
-        tifffile.imwrite(out_fname, data.astype(datatype))
+        # horizontal differencing helps compression of integer data
+        predictor = (compression is not None 
+                     and np.dtype(datatype).kind in 'iu')
+        if tile is None or data.dtype == datatype:
+            tifffile.imwrite(out_fname, data.astype(datatype, copy=False), 
+                             compression=compression, predictor=predictor,
+                             tile=tile)
+        else:
+            # cast tile by tile, rather than copying the whole image.  No 
+            # predictor: tifffile 2022.3.16 corrupts tiles from an iterator
+            # when one is used
+            tifffile.imwrite(out_fname, _tiles(data, datatype, tile),
+                             shape=data.shape, dtype=datatype,
+                             compression=compression, predictor=False,
+                             tile=tile)
         print(f"Saving {out_fname}...")
+        return out_fname
+
 
-        # overwrite (limited) exif data will full metadata from original image
+    def copy_exif(self, out_fname):
+        """
+        Overwrite the (limited) exif data of out_fname with the full metadata
+        from the original image, according to the "includeexif" and 
+        "removeoriginal" attributes.
+        """
         if self.includeexif:
-            with exiftool.ExifTool() as et:
-                et.execute(b"-tagsfromfile",
-                           bytes(self.filename, "utf-8"),
-                           bytes(out_fname, "utf-8"))
+            self._et.execute(b"-tagsfromfile",
+                             bytes(self.filename, "utf-8"),
+                             bytes(out_fname, "utf-8"))
 
-        if self.removeoriginal:
-            os.remove(out_fname + '_original')
+            if self.removeoriginal:
+                os.remove(out_fname + '_original')
         
         return
 
 
-def raw_to_temperature(S, planck):
+def _tiles(a, dtype, tile):
+    """Yield the tiles of the 2D array a, in row-major order, cast to dtype"""
+    th, tw = tile
+    for y in range(0, a.shape[0], th):
+        for x in range(0, a.shape[1], tw):
+            yield a[y:y+th, x:x+tw].astype(dtype, copy=False)
+
+
+def process_batch(filenames, outtype='raw', max_workers=None, **kwargs):
+    """
+    Convert and save many FLIR images in one pass.
+
+    All files are read through a single exiftool process, while the output
+    files are written by a pool of threads (compression and file I/O release
+    the GIL).  At most max_workers images are held in memory at a time.  
+    Files that cannot be processed, e.g. non-radiometric images, are 
+    reported and skipped.
+
+    Parameters
+    ----------
+    filenames : iterable of str
+        Images to process.
+    outtype : str (optional)
+        Type of data to save, as for FLIR_image.  Default is "raw".
+    max_workers : int (optional)
+        Number of writer threads, as for concurrent.futures.ThreadPoolExecutor
+    **kwargs :
+        Further keyword arguments passed to FLIR_image.
+
+    Returns
+    -------
+    failed : list of str
+        Names of the files that could not be processed.
+
+    """
+    if max_workers is None:  # ThreadPoolExecutor's default
+        max_workers = min(32, (os.cpu_count() or 1) + 4)
+    failed = []
+
+    def finish(im, job):
+        # exiftool is not thread-safe: copy the exif data from this thread
+        try:
+            im.copy_exif(job.result())
+        except Exception as err:
+            print(f"Failed to process {im.filename}: {err!r}")
+            failed.append(im.filename)
+        finally:
+            im.close(keep_raw=False)
+
+    with exiftool.ExifTool() as et, ThreadPoolExecutor(max_workers) as pool:
+        jobs = deque()
+        try:
+            for filename in filenames:
+                try:
+                    im = FLIR_image(filename, outtype=outtype, et=et, 
+                                    **kwargs)
+                except Exception as err:
+                    print(f"Skipping {filename}: {err!r}")
+                    failed.append(filename)
+                    continue
+                jobs.append((im, pool.submit(im.write_data)))
+                del im
+                while len(jobs) > max_workers:
+                    finish(*jobs.popleft())
+        finally:
+            while jobs:
+                finish(*jobs.popleft())
+
+    return failed
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _raw_to_T(S, B, F, O, r1r2, out):
+    """Fused, parallel kernel for raw_to_temperature on flattened arrays"""
+    for i in prange(S.size):
+        out[i] = B / math.log(r1r2 / (S[i] + O) + F)
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _T_to_raw(T, B, F, O, r1r2, out):
+    """
+    Fused, parallel kernel for temperature_to_raw on flattened arrays.  Values
+    are rounded and clipped to the uint16 range of out.
+    """
+    for i in prange(T.size):
+        v = r1r2 / (math.exp(B / T[i]) - F) - O
+        if v < 0.:
+            out[i] = 0
+        elif v > 65535.:
+            out[i] = 65535
+        else:
+            out[i] = np.uint16(v + 0.5)
+
+
+@njit(cache=True)
+def _stats(a):
+    """
+    Minimum, maximum, mean and standard deviation of a 1D array.  As for 
+    numpy's reductions, all four are NaN if the array contains a NaN.
+    """
+    mn = a[0]
+    mx = a[0]
+    s  = 0.
+    s2 = 0.
+    for i in range(a.size):
+        v = a[i]
+        if math.isnan(v):
+            return math.nan, math.nan, math.nan, math.nan
+        mn = min(mn, v)
+        mx = max(mx, v)
+        s  += v
+        s2 += v*v
+    mean = s / a.size
+    return mn, mx, mean, math.sqrt(max(s2 / a.size - mean*mean, 0.))
+
+
+# numba's default threading layer does not allow parallel kernels to be 
+# launched from several threads at once
+_kernel_lock = threading.Lock()
+
+
+def raw_to_temperature(S, planck, dtype=np.float32):
     r"""
     Convert RAW thermal image values to temperature, :math:`T`, (in 
     Kelvin) via 
@@ -193,20 +441,31 @@ def raw_to_temperature(S, planck):
     :math:`R_1` and :math:`R_2` are Planck constants that can be found 
     from the exif data, and :math:`S` is the (16-bit) RAW value.
 
+    The calculation is done in single precision by default, which is ample
+    for 16-bit RAW values, in a single pass over the image without 
+    temporary arrays.  Pass dtype=np.float64 if double precision is really 
+    needed.
+
     See https://exiftool.org/forum/index.php?topic=4898.60
     """
-    B = planck["B"]
-    F = planck["F"]
-    O = planck["O"]
-    R1 = planck["R1"]
-    R2 = planck["R2"]
-
-    data = B / np.log(R1 / (R2*(S + O)) + F)
+    dtype = np.dtype(dtype)
+    work = np.promote_types(dtype, np.float32)  # numba has no float16 maths
+    c = work.type
+    B = c(planck["B"])
+    F = c(planck["F"])
+    O = c(planck["O"])
+    r1r2 = c(planck["R1"] / planck["R2"])  # hoisted out of the pixel loop
+
+    S = np.asarray(S)
+    S = S.astype(S.dtype.newbyteorder('='), copy=False)  # numba needs native
+    data = np.empty(S.shape, dtype=work)
+    with _kernel_lock:
+        _raw_to_T(S.ravel(), B, F, O, r1r2, data.ravel())
     
-    return data
+    return data.astype(dtype, copy=False)
 
 
-def temperature_to_raw(T, planck):
+def temperature_to_raw(T, planck, dtype=np.float32):
     r"""
     Convert absolute temperatures, :math:`T`, to RAW thermal image values via
     .. math::
@@ -216,28 +475,38 @@ def temperature_to_raw(T, planck):
     :math:`R_1` and :math:`R_2` are Planck constants that can be found 
     from the exif data, and :math:`S` is the (16-bit) RAW value.
 
+    As for raw_to_temperature, the calculation is done in single precision
+    unless another dtype is given.  Results are rounded to the nearest 
+    integer and clipped to [0, 65535] rather than wrapping around.
+
     See https://exiftool.org/forum/index.php?topic=4898.60
     """
-    B = planck["B"]
-    F = planck["F"]
-    O = planck["O"]
-    R1 = planck["R1"]
-    R2 = planck["R2"]
-    return (R1 / (R2*(np.exp(B/T) - F)) - O).astype('uint16')
+    dtype = np.dtype(dtype)
+    work = np.promote_types(dtype, np.float32)
+    c = work.type
+    B = c(planck["B"])
+    F = c(planck["F"])
+    O = c(planck["O"])
+    r1r2 = c(planck["R1"] / planck["R2"])  # hoisted out of the pixel loop
+
+    T = np.asarray(T, dtype=work)
+    data = np.empty(T.shape, dtype='uint16')
+    with _kernel_lock:
+        _T_to_raw(T.ravel(), B, F, O, r1r2, data.ravel())
+    return data[()] if data.ndim == 0 else data
 
 
 if __name__ == "__main__":
     import sys
-    import os
+    import glob
 
-    filename = sys.argv[1]
+    if len(sys.argv) < 2:
+        sys.exit(f"usage: {sys.argv[0]} FILENAME|'PATTERN' [raw|T]")
+
+    # Filenames may be given as a (quoted) glob pattern, e.g. '*.jpg'
+    filenames = sorted(glob.glob(sys.argv[1])) or [sys.argv[1]]
     out_type = "raw"
     if len(sys.argv) > 2:
         out_type = sys.argv[2]
-    #print(out_type)
-    im = FLIR_image(filename, bitdepth=16, outtype=out_type)
-    im.save_data()
-
-    
-    #print(im.extract_raw_image().shape)
-    
+    if process_batch(filenames, outtype=out_type, bitdepth=16):
+        sys.exit(1)